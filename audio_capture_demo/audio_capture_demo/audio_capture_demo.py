@@ -1,40 +1,79 @@
 from __future__ import annotations
 
 import asyncio
+import binascii
+import functools
+import importlib.util
+import io
+import logging
 import os
-from tempfile import NamedTemporaryFile
-from urllib.request import urlopen
+import threading
+from collections.abc import AsyncIterator, Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any
 
 import reflex as rx
-from reflex_audio_capture import AudioRecorderPolyfill, get_codec, strip_codec_part
-from reflex_intersection_observer import intersection_observer
+from reflex_audio_capture import AudioRecorderPolyfill, get_codec
 
-try:
+if TYPE_CHECKING:
+    import av
+    import numpy as np
+    from faster_whisper import WhisperModel
     from openai import AsyncOpenAI
-except ImportError:  # pragma: no cover
-    AsyncOpenAI = None
 
-try:
-    from faster_whisper import WhisperModel
-except ImportError:  # pragma: no cover
-    WhisperModel = None
+# Backends are imported on first use.
+OPENAI_INSTALLED = importlib.util.find_spec("openai") is not None
+FASTER_WHISPER_INSTALLED = importlib.util.find_spec("faster_whisper") is not None
 
 WHISPER_BACKEND = os.getenv("WHISPER_BACKEND", "openai").strip().lower()
 OPENAI_WHISPER_MODEL = os.getenv("OPENAI_WHISPER_MODEL", "whisper-1")
 FASTER_WHISPER_MODEL = os.getenv("FASTER_WHISPER_MODEL", "base")
 FASTER_WHISPER_DEVICE = os.getenv("FASTER_WHISPER_DEVICE", "cpu")
-FASTER_WHISPER_COMPUTE_TYPE = os.getenv("FASTER_WHISPER_COMPUTE_TYPE", "int8")
+FASTER_WHISPER_DEVICE_INDEX = [
+    int(index) for index in os.getenv("FASTER_WHISPER_DEVICE_INDEX", "0").split(",")
+]
+FASTER_WHISPER_COMPUTE_TYPE = os.getenv("FASTER_WHISPER_COMPUTE_TYPE") or (
+    "int8_float16" if FASTER_WHISPER_DEVICE.startswith("cuda") else "int8"
+)
+FASTER_WHISPER_OPTIONS: dict[str, Any] = {
+    "vad_filter": True,
+    "vad_parameters": {"min_silence_duration_ms": 500},
+    "condition_on_previous_text": False,
+    "beam_size": 1,
+    "best_of": 1,
+    "temperature": 0,
+    "without_timestamps": True,
+}
 
-openai_client = AsyncOpenAI() if AsyncOpenAI is not None else None
 faster_whisper_model: WhisperModel | None = None
+faster_whisper_model_lock = threading.Lock()
+# Only used on the faster-whisper worker; rebuilt when the input format changes.
+faster_whisper_resampler: av.AudioResampler | None = None
+faster_whisper_source: tuple[str, str, int] | None = None
+# One model worker; at most two chunks may wait for it.
+faster_whisper_executor = ThreadPoolExecutor(
+    max_workers=1,
+    thread_name_prefix="whisper",
+)
+faster_whisper_slots = asyncio.Semaphore(2)
+
+logger = logging.getLogger(__name__)
 
 REF = "myaudio"
+AUDIO_SUFFIXES = {
+    "audio/mpeg": ".mp3",
+    "audio/webm": ".webm",
+    "audio/ogg": ".ogg",
+    "audio/wav": ".wav",
+}
+MAX_TRANSCRIPT_CHARS = 50_000
 
 
+@functools.lru_cache(maxsize=8)
 def get_backend_error(backend: str) -> str:
-    if backend == "openai" and openai_client is None:
+    if backend == "openai" and not OPENAI_INSTALLED:
         return "Backend 'openai' ist aktiv, aber das Paket 'openai' ist nicht installiert."
-    if backend == "faster-whisper" and WhisperModel is None:
+    if backend == "faster-whisper" and not FASTER_WHISPER_INSTALLED:
         return (
             "Backend 'faster-whisper' ist aktiv, aber das Paket "
             "'faster-whisper' ist nicht installiert."
@@ -44,34 +83,127 @@ def get_backend_error(backend: str) -> str:
     return ""
 
 
+@functools.lru_cache(maxsize=8)
+def get_audio_suffix(mime_type: str) -> str:
+    base_type = mime_type.partition(";")[0]
+    return AUDIO_SUFFIXES.get(base_type) or "." + base_type.rpartition("/")[2]
+
+
+@functools.cache
+def get_openai_client() -> AsyncOpenAI:
+    from openai import AsyncOpenAI
+
+    return AsyncOpenAI()
+
+
 def get_faster_whisper_model() -> WhisperModel:
     global faster_whisper_model
-    if WhisperModel is None:
+    if not FASTER_WHISPER_INSTALLED:
         raise RuntimeError(
             "faster-whisper backend requested, but package is not installed.",
         )
-    if faster_whisper_model is None:
-        faster_whisper_model = WhisperModel(
-            FASTER_WHISPER_MODEL,
-            device=FASTER_WHISPER_DEVICE,
-            compute_type=FASTER_WHISPER_COMPUTE_TYPE,
-        )
+    with faster_whisper_model_lock:
+        if faster_whisper_model is None:
+            cpu_threads = int(
+                os.environ.setdefault(
+                    "OMP_NUM_THREADS",
+                    str(max(1, (os.cpu_count() or 2) // 2)),
+                ),
+            )
+            os.environ.setdefault("CT2_USE_EXPERIMENTAL_PACKED_GEMM", "1")
+            import numpy as np
+            from faster_whisper import WhisperModel
+            from faster_whisper.vad import get_vad_model
+
+            model = WhisperModel(
+                FASTER_WHISPER_MODEL,
+                device=FASTER_WHISPER_DEVICE,
+                device_index=FASTER_WHISPER_DEVICE_INDEX,
+                compute_type=FASTER_WHISPER_COMPUTE_TYPE,
+                cpu_threads=cpu_threads,
+                num_workers=1,
+            )
+            # VAD would drop the silence, so warm up the encoder and VAD separately.
+            segments, _ = model.transcribe(np.zeros(16000, dtype=np.float32))
+            list(segments)
+            get_vad_model()
+            faster_whisper_model = model
     return faster_whisper_model
 
 
-def transcribe_with_faster_whisper(audio_bytes: bytes, suffix: str) -> str:
+async def warm_up_faster_whisper():
+    """Load the faster-whisper model in the background on backend startup."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(faster_whisper_executor, get_faster_whisper_model)
+
+
+def decode_for_faster_whisper(audio_bytes: bytes) -> np.ndarray:
+    global faster_whisper_resampler, faster_whisper_source
+    import av
+    import numpy as np
+
+    pcm = []
+    with av.open(io.BytesIO(audio_bytes), metadata_errors="ignore") as container:
+        for frame in container.decode(audio=0):
+            source = (frame.format.name, frame.layout.name, frame.sample_rate)
+            if faster_whisper_resampler is None or source != faster_whisper_source:
+                faster_whisper_source = source
+                faster_whisper_resampler = av.AudioResampler(
+                    format="flt",
+                    layout="mono",
+                    rate=16000,
+                )
+            pcm.extend(
+                resampled.to_ndarray()[0]
+                for resampled in faster_whisper_resampler.resample(frame)
+            )
+    return np.concatenate(pcm) if pcm else np.zeros(0, dtype=np.float32)
+
+
+def transcribe_with_faster_whisper(
+    audio_bytes: bytes,
+    emit: Callable[[str], None],
+) -> None:
     model = get_faster_whisper_model()
-    with NamedTemporaryFile(suffix=suffix, delete=False) as temp_audio:
-        temp_audio.write(audio_bytes)
-        temp_path = temp_audio.name
-    try:
-        segments, _ = model.transcribe(temp_path)
-        return " ".join(segment.text.strip() for segment in segments).strip()
-    finally:
-        try:
-            os.unlink(temp_path)
-        except OSError:
-            pass
+    audio = decode_for_faster_whisper(audio_bytes)
+    if not audio.size:
+        return
+    segments, _ = model.transcribe(audio, **FASTER_WHISPER_OPTIONS)
+    for segment in segments:
+        text = segment.text.strip()
+        if text:
+            emit(text)
+
+
+async def stream_faster_whisper(audio_bytes: bytes) -> AsyncIterator[str]:
+    """Yield the segments of `audio_bytes` as the worker decodes them."""
+    loop = asyncio.get_running_loop()
+    segments: asyncio.Queue[str | None] = asyncio.Queue()
+
+    def emit(text: str) -> None:
+        loop.call_soon_threadsafe(segments.put_nowait, text)
+
+    job = loop.run_in_executor(
+        faster_whisper_executor,
+        transcribe_with_faster_whisper,
+        audio_bytes,
+        emit,
+    )
+    job.add_done_callback(lambda _: segments.put_nowait(None))
+    while (text := await segments.get()) is not None:
+        yield text
+    await job
+
+
+def append_to_transcript(transcript: str, text: str) -> str:
+    if not text:
+        return transcript
+    transcript = f"{transcript}\n{text}" if transcript else text
+    if len(transcript) > MAX_TRANSCRIPT_CHARS:
+        cut = len(transcript) - MAX_TRANSCRIPT_CHARS
+        line_start = transcript.find("\n", cut - 1) + 1
+        transcript = transcript[line_start or cut :]
+    return transcript
 
 
 class State(rx.State):
@@ -79,7 +211,7 @@ class State(rx.State):
 
     has_error: bool = False
     processing: bool = False
-    transcript: list[str] = []
+    transcript: str = ""
     timeslice: int = 0
     device_id: str = ""
     use_mp3: bool = True
@@ -88,54 +220,59 @@ class State(rx.State):
 
     @rx.event(background=True)
     async def on_data_available(self, chunk: str):
+        backend = self.whisper_backend
         mime_type = get_codec(chunk)
-        audio_type = mime_type.partition("/")[2]
-        if audio_type == "mpeg":
-            audio_type = "mp3"
-        with urlopen(strip_codec_part(chunk)) as audio_data:
-            audio_bytes = audio_data.read()
-            try:
-                async with self:
-                    self.processing = True
-                backend = self.whisper_backend
-                backend_error = get_backend_error(backend)
-                if backend_error:
-                    raise RuntimeError(backend_error)
-                if backend == "faster-whisper":
-                    transcription_text = await asyncio.to_thread(
-                        transcribe_with_faster_whisper,
-                        audio_bytes,
-                        "." + audio_type,
-                    )
-                elif backend == "openai":
-                    if openai_client is None:
-                        raise RuntimeError(
-                            "openai backend requested, but package is not installed.",
-                        )
-                    transcription = await openai_client.audio.transcriptions.create(
-                        model=OPENAI_WHISPER_MODEL,
-                        file=("temp." + audio_type, audio_bytes, mime_type),
-                    )
-                    transcription_text = transcription.text
+        audio_bytes = binascii.a2b_base64(chunk.partition(",")[2])
+        async with self:
+            self.processing = True
+        # Runs without the state lock; results are written back as they arrive.
+        try:
+            backend_error = get_backend_error(backend)
+            if backend_error:
+                raise RuntimeError(backend_error)
+            if backend == "faster-whisper":
+                transcription_text = ""
+                if faster_whisper_slots.locked():
+                    logger.warning("faster-whisper is falling behind, dropping chunk.")
                 else:
-                    raise ValueError(
-                        "Unsupported WHISPER_BACKEND value. Use 'openai' or"
-                        " 'faster-whisper'.",
-                    )
-            except Exception:
-                async with self:
-                    self.has_error = True
-                    self.backend_error = get_backend_error(self.whisper_backend)
-                yield capture.stop()
-                raise
-            finally:
-                async with self:
-                    self.processing = False
+                    async with faster_whisper_slots:
+                        async for text in stream_faster_whisper(audio_bytes):
+                            async with self:
+                                self.transcript = append_to_transcript(
+                                    self.transcript,
+                                    text,
+                                )
+                            yield rx.scroll_to("end-of-transcript")
+            elif backend == "openai":
+                client = get_openai_client()
+                transcription = await client.audio.transcriptions.create(
+                    model=OPENAI_WHISPER_MODEL,
+                    file=("temp" + get_audio_suffix(mime_type), audio_bytes, mime_type),
+                )
+                transcription_text = transcription.text
+            else:
+                raise ValueError(
+                    "Unsupported WHISPER_BACKEND value. Use 'openai' or"
+                    " 'faster-whisper'.",
+                )
+        except Exception:
             async with self:
-                self.transcript.append(transcription_text)
+                self.processing = False
+                self.has_error = True
+                self.backend_error = get_backend_error(backend)
+            yield capture.stop()
+            raise
+        async with self:
+            self.processing = False
+            self.transcript = append_to_transcript(
+                self.transcript,
+                transcription_text,
+            )
+        if transcription_text:
+            yield rx.scroll_to("end-of-transcript")
 
     @rx.event
-    def set_transcript(self, value: list[str]):
+    def set_transcript(self, value: str):
         self.transcript = value
 
     @rx.event
@@ -191,15 +328,9 @@ def input_device_select() -> rx.Component:
 def transcript() -> rx.Component:
     return rx.scroll_area(
         rx.vstack(
-            rx.foreach(State.transcript, rx.text),
-            intersection_observer(
-                height="1px",
-                id="end-of-transcript",
-                root="#scroller",
-                # Remove lambda after reflex-dev/reflex#4552
-                on_non_intersect=lambda _: rx.scroll_to("end-of-transcript"),
-                visibility="hidden",
-            ),
+            rx.text(State.transcript, white_space="pre-wrap"),
+            # Scrolled into view by on_data_available after each new line.
+            rx.box(id="end-of-transcript"),
         ),
         id="scroller",
         width="100%",
@@ -264,7 +395,7 @@ def index() -> rx.Component:
                     rx.spacer(),
                     rx.icon_button(
                         "trash-2",
-                        on_click=State.set_transcript([]),
+                        on_click=State.set_transcript(""),
                         margin_bottom="4px",
                     ),
                     align="center",
@@ -282,3 +413,5 @@ def index() -> rx.Component:
 # Add state and page to the app.
 app = rx.App()
 app.add_page(index)
+if WHISPER_BACKEND == "faster-whisper" and FASTER_WHISPER_INSTALLED:
+    app.register_lifespan_task(warm_up_faster_whisper)
@@ -70,15 +70,22 @@ refs['mediarecorder_start_{{ ref }}'] = useCallback(() => {
             mediaRecorderRef.addEventListener('pause', updateState)
             mediaRecorderRef.addEventListener('resume', updateState)
             mediaRecorderRef.addEventListener('error', updateState)
+            // Reads finish asynchronously; chain them so chunks (and on_stop) stay in order.
+            let pendingRead = Promise.resolve()
             mediaRecorderRef.addEventListener(
                 "dataavailable",
                 (e) => {
                     if (e.data.size > 0) {
-                        var a = new FileReader();
-                        a.onload = (e) => {
-                            {{ on_data_available }}(e.target.result);
-                        }
-                        a.readAsDataURL(e.data);
+                        const blob = e.data
+                        pendingRead = pendingRead.then(() => new Promise((resolve) => {
+                            var a = new FileReader();
+                            a.onload = (e) => {
+                                {{ on_data_available }}(e.target.result);
+                                resolve();
+                            }
+                            a.onerror = resolve;
+                            a.readAsDataURL(blob);
+                        }));
                     }
                 }
             );
@@ -207,12 +214,8 @@ class AudioRecorderPolyfill(rx.Component):
         if isinstance(on_stop, rx.EventChain):
             on_stop = rx.Var.create(on_stop)
         if on_stop is not None:
-            on_stop_callback = "\n".join(
-                [
-                    f"mediaRecorderRef.addEventListener('stop', {on_stop!s})",
-                    f"addEventListener('beforeunload', {on_stop!s})",
-                ],
-            )
+            # The template's beforeunload handler stops the recorder, which fires this too.
+            on_stop_callback = f"mediaRecorderRef.addEventListener('stop', () => pendingRead.then({on_stop!s}))"
         else:
             on_stop_callback = ""
 
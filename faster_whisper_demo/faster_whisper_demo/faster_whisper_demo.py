@@ -1,60 +1,216 @@
 from __future__ import annotations
 
 import asyncio
+import binascii
+import io
+import logging
 import os
-from tempfile import NamedTemporaryFile
-from typing import Any
-from urllib.request import urlopen
+import threading
+from collections import defaultdict, deque
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
 
+import av
+import numpy as np
 import reflex as rx
-from reflex_audio_capture import AudioRecorderPolyfill, get_codec, strip_codec_part
+from reflex_audio_capture import AudioRecorderPolyfill
 
-try:
-    from faster_whisper import WhisperModel
-except ImportError:  # pragma: no cover
-    WhisperModel = None
+if TYPE_CHECKING:
+    from faster_whisper import BatchedInferencePipeline, WhisperModel
 
 MODEL_NAME = os.getenv("FASTER_WHISPER_MODEL", "base")
 MODEL_DEVICE = os.getenv("FASTER_WHISPER_DEVICE", "cpu")
-MODEL_COMPUTE_TYPE = os.getenv("FASTER_WHISPER_COMPUTE_TYPE", "int8")
+MODEL_DEVICE_INDEX = [
+    int(index) for index in os.getenv("FASTER_WHISPER_DEVICE_INDEX", "0").split(",")
+]
+# int8 weights with fp16 compute on CUDA, plain int8 on CPU.
+MODEL_COMPUTE_TYPE = os.getenv("FASTER_WHISPER_COMPUTE_TYPE") or (
+    "int8_float16" if MODEL_DEVICE.startswith("cuda") else "int8"
+)
 MODEL_LANGUAGE = os.getenv("FASTER_WHISPER_LANGUAGE", "de")
+# Leave half of the cores to the Reflex backend.
+CPU_THREADS = int(
+    os.environ.setdefault("OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 2) // 2))),
+)
+os.environ.setdefault("CT2_USE_EXPERIMENTAL_PACKED_GEMM", "1")
+# Whisper pads every input to 30 s, so chunks are batched into longer windows.
+FLUSH_SECONDS = float(os.getenv("FASTER_WHISPER_FLUSH_SECONDS", "10"))
+BATCH_SIZE = int(os.getenv("FASTER_WHISPER_BATCH_SIZE", "8"))
+SAMPLE_RATE = 16000
+# Reflex resends the whole transcript on every change.
+MAX_TRANSCRIPT_CHARS = 50_000
+# Skip silence, decode greedily and never carry text over between windows.
+TRANSCRIBE_OPTIONS: dict[str, Any] = {
+    "vad_filter": True,
+    "vad_parameters": {"min_silence_duration_ms": 500},
+    "condition_on_previous_text": False,
+    "beam_size": 1,
+    "best_of": 1,
+    "temperature": 0,
+    "without_timestamps": True,
+}
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AudioWindow:
+    """16 kHz mono PCM of one client, waiting to be transcribed."""
+
+    frames: deque[np.ndarray] = field(default_factory=deque)
+    samples: int = 0
+    # Reused across chunks; rebuilt when the input format changes.
+    source: tuple[str, str, int] | None = None
+    resampler: av.AudioResampler | None = None
+
+    def decode(self, audio_bytes: bytes) -> None:
+        """Decode one encoded recorder chunk and append its samples."""
+        with av.open(io.BytesIO(audio_bytes), metadata_errors="ignore") as container:
+            for frame in container.decode(audio=0):
+                source = (frame.format.name, frame.layout.name, frame.sample_rate)
+                if self.resampler is None or source != self.source:
+                    self.drain()
+                    self.source = source
+                    self.resampler = av.AudioResampler(
+                        format="flt",
+                        layout="mono",
+                        rate=SAMPLE_RATE,
+                        frame_size=SAMPLE_RATE // 4,
+                    )
+                self._push(self.resampler.resample(frame))
+
+    def drain(self) -> None:
+        """Flush samples still held back by the resampler."""
+        if self.resampler is not None:
+            self._push(self.resampler.resample(None))
+            self.resampler = None
+
+    def take(self) -> np.ndarray:
+        """Return the buffered audio as one array and empty the window."""
+        audio = np.concatenate(self.frames)
+        self.frames.clear()
+        self.samples = 0
+        return audio
+
+    def _push(self, frames: Iterable[av.AudioFrame]) -> None:
+        for frame in frames:
+            pcm = frame.to_ndarray()[0]
+            self.frames.append(pcm)
+            self.samples += len(pcm)
+
 
 _model: Any = None
+_model_lock = threading.Lock()
+_pipeline: Any = None
+# Per client token; only the decoder thread touches it.
+_windows: defaultdict[str, AudioWindow] = defaultdict(AudioWindow)
+# Every chunk is decoded, so windows stay continuous while the model is busy.
+_decoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="decoder")
+# One worker owns the model; a model slower than real time drops whole windows.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="whisper")
+_pending = asyncio.Semaphore(2)
 
 
 def get_model() -> WhisperModel:
     global _model
-    if WhisperModel is None:
-        raise RuntimeError(
-            "faster-whisper ist nicht installiert. Bitte `uv sync` im Ordner "
-            "`faster_whisper_demo` ausfuehren.",
-        )
-    if _model is None:
-        _model = WhisperModel(
-            MODEL_NAME,
-            device=MODEL_DEVICE,
-            compute_type=MODEL_COMPUTE_TYPE,
-        )
+    with _model_lock:
+        if _model is None:
+            # Imported here so compiling the frontend never loads CTranslate2.
+            try:
+                from faster_whisper import WhisperModel
+            except ImportError as err:
+                raise RuntimeError(
+                    "faster-whisper ist nicht installiert. Bitte `uv sync` im "
+                    "Ordner `faster_whisper_demo` ausfuehren.",
+                ) from err
+            _model = WhisperModel(
+                MODEL_NAME,
+                device=MODEL_DEVICE,
+                device_index=MODEL_DEVICE_INDEX,
+                compute_type=MODEL_COMPUTE_TYPE,
+                cpu_threads=CPU_THREADS,
+                num_workers=1,
+            )
     return _model
 
 
-def transcribe_bytes(audio_bytes: bytes, suffix: str) -> str:
+def get_pipeline() -> BatchedInferencePipeline:
+    global _pipeline
     model = get_model()
-    with NamedTemporaryFile(suffix=suffix, delete=False) as temp_audio:
-        temp_audio.write(audio_bytes)
-        temp_path = temp_audio.name
-    try:
-        segments, _ = model.transcribe(
-            temp_path,
-            language=MODEL_LANGUAGE or None,
-            vad_filter=True,
-        )
-        return " ".join(segment.text.strip() for segment in segments).strip()
-    finally:
-        try:
-            os.unlink(temp_path)
-        except OSError:
-            pass
+    if _pipeline is None:
+        from faster_whisper import BatchedInferencePipeline
+
+        _pipeline = BatchedInferencePipeline(model=model)
+    return _pipeline
+
+
+def warm_up_pipeline() -> None:
+    """Load the model, pipeline and VAD and run one full batch through them."""
+    pipeline = get_pipeline()
+    from faster_whisper.vad import get_vad_model
+
+    get_vad_model()
+    # VAD would drop silence before the encoder, so clips are passed explicitly.
+    segments, _ = pipeline.transcribe(
+        np.zeros(BATCH_SIZE * SAMPLE_RATE, dtype=np.float32),
+        language=MODEL_LANGUAGE or None,
+        batch_size=BATCH_SIZE,
+        clip_timestamps=[{"start": i, "end": i + 1} for i in range(BATCH_SIZE)],
+        **TRANSCRIBE_OPTIONS,
+    )
+    list(segments)
+
+
+async def warm_up_model():
+    """Load the model in the background as soon as the backend starts."""
+    await asyncio.get_running_loop().run_in_executor(_executor, warm_up_pipeline)
+
+
+def transcribe_audio(audio: np.ndarray, emit: Callable[[str], None]) -> None:
+    """Transcribe `audio`, handing each segment to `emit` as it is decoded."""
+    segments, _ = get_pipeline().transcribe(
+        audio,
+        language=MODEL_LANGUAGE or None,
+        batch_size=BATCH_SIZE,
+        **TRANSCRIBE_OPTIONS,
+    )
+    for segment in segments:
+        text = segment.text.strip()
+        if text:
+            emit(text)
+
+
+def buffer_chunk(token: str, payload: str) -> np.ndarray | None:
+    """Add a recorder chunk to the client's window and return it once full."""
+    audio_bytes = binascii.a2b_base64(payload)
+    window = _windows[token]
+    window.decode(audio_bytes)
+    if window.samples >= FLUSH_SECONDS * SAMPLE_RATE:
+        return window.take()
+    return None
+
+
+def flush_window(token: str) -> np.ndarray | None:
+    """Return whatever audio is still buffered for the client."""
+    window = _windows.pop(token, None)
+    if window is None:
+        return None
+    window.drain()
+    return window.take() if window.samples else None
+
+
+def append_to_transcript(transcript: str, text: str) -> str:
+    if not text:
+        return transcript
+    transcript = f"{transcript}\n{text}" if transcript else text
+    if len(transcript) > MAX_TRANSCRIPT_CHARS:
+        # Cut at the first line start inside the limit, or mid-line if there is none.
+        cut = len(transcript) - MAX_TRANSCRIPT_CHARS
+        line_start = transcript.find("\n", cut - 1) + 1
+        transcript = transcript[line_start or cut :]
+    return transcript
 
 
 class State(rx.State):
@@ -63,40 +219,68 @@ class State(rx.State):
     processing: bool = False
     has_error: bool = False
     error_message: str = ""
-    transcript: list[str] = []
+    transcript: str = ""
     timeslice: int = 2500
 
     @rx.event(background=True)
     async def on_data_available(self, chunk: str):
-        mime_type = get_codec(chunk)
-        audio_type = mime_type.partition("/")[2]
-        if audio_type == "mpeg":
-            audio_type = "mp3"
+        # The recorder always delivers a `data:<mime>;base64,<payload>` URI.
+        async for event in self._handle_audio(
+            buffer_chunk,
+            self.router.session.client_token,
+            chunk.partition(",")[2],
+        ):
+            yield event
 
-        with urlopen(strip_codec_part(chunk)) as audio_data:
-            audio_bytes = audio_data.read()
+    @rx.event(background=True)
+    async def on_stop(self):
+        # Fired after the last chunk, so the flush queues behind it.
+        async for event in self._handle_audio(
+            flush_window,
+            self.router.session.client_token,
+        ):
+            yield event
 
+    async def _handle_audio(self, func: Callable[..., np.ndarray | None], *args: Any):
+        loop = asyncio.get_running_loop()
+        # Submit before any await to keep the decoder in event order.
+        decoded = loop.run_in_executor(_decoder, func, *args)
         try:
-            async with self:
-                self.processing = True
-                self.has_error = False
-                self.error_message = ""
-            text = await asyncio.to_thread(
-                transcribe_bytes,
-                audio_bytes,
-                "." + audio_type,
-            )
-            if text:
-                async with self:
-                    self.transcript.append(text)
+            audio = await decoded
+            if audio is None:
+                return
+            if _pending.locked():
+                logger.warning("Transkription haengt hinterher, Fenster verworfen.")
+                return
+            async with _pending:
+                await self._transcribe(audio)
         except Exception as err:
             async with self:
+                self.processing = False
                 self.has_error = True
                 self.error_message = str(err)
             yield recorder.stop()
-        finally:
+
+    async def _transcribe(self, audio: np.ndarray):
+        loop = asyncio.get_running_loop()
+        # Segments stream in as they are decoded; None ends the job.
+        segments: asyncio.Queue[str | None] = asyncio.Queue()
+
+        def emit(text: str) -> None:
+            loop.call_soon_threadsafe(segments.put_nowait, text)
+
+        job = loop.run_in_executor(_executor, transcribe_audio, audio, emit)
+        job.add_done_callback(lambda _: segments.put_nowait(None))
+        async with self:
+            self.processing = True
+        while (text := await segments.get()) is not None:
             async with self:
-                self.processing = False
+                self.transcript = append_to_transcript(self.transcript, text)
+        await job
+        async with self:
+            self.processing = False
+            self.has_error = False
+            self.error_message = ""
 
     @rx.event
     def on_error(self, err: dict):
@@ -109,15 +293,17 @@ class State(rx.State):
 
     @rx.event
     def clear_transcript(self):
-        self.transcript = []
+        self.transcript = ""
 
 
 recorder = AudioRecorderPolyfill.create(
     id="faster_whisper_recorder",
     on_data_available=State.on_data_available,
+    on_stop=State.on_stop,
     on_error=State.on_error,
     timeslice=State.timeslice,
-    use_mp3=True,
+    # Plain WAV chunks: no MP3 encoding in the browser, no MP3 decoding here.
+    use_mp3=False,
 )
 
 
@@ -180,12 +366,7 @@ def index() -> rx.Component:
                 ),
                 rx.divider(),
                 rx.scroll_area(
-                    rx.vstack(
-                        rx.foreach(State.transcript, lambda line: rx.text(line)),
-                        spacing="2",
-                        align="start",
-                        width="100%",
-                    ),
+                    rx.text(State.transcript, white_space="pre-wrap"),
                     type="always",
                     scrollbars="vertical",
                     style={"height": "45vh", "width": "100%"},
@@ -203,3 +384,4 @@ def index() -> rx.Component:
 
 app = rx.App()
 app.add_page(index)
+app.register_lifespan_task(warm_up_model)
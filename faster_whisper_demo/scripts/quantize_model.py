@@ -0,0 +1,60 @@
+"""Convert a Whisper checkpoint into a pre-quantized CTranslate2 model.
+
+CTranslate2 re-quantizes the weights on every load when the stored type differs
+from the requested compute type. Converting once up front moves that work out of
+the app startup:
+
+    uv run --with transformers --with torch python scripts/quantize_model.py
+    FASTER_WHISPER_MODEL=./models/base-int8 uv run reflex run
+
+The conversion needs `transformers` and `torch`; the app itself does not.
+"""
+
+from __future__ import annotations
+
+import argparse
+
+from ctranslate2.converters import TransformersConverter
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Convert a Whisper checkpoint into a pre-quantized CTranslate2 model.",
+    )
+    parser.add_argument(
+        "--model",
+        default="openai/whisper-base",
+        help="Hugging Face model id or local checkpoint (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default="models/base-int8",
+        help="Target directory for the converted model (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--quantization",
+        default="int8",
+        help="Stored weight type; match FASTER_WHISPER_COMPUTE_TYPE, e.g. int8 "
+        "for CPU or int8_float16 for CUDA (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Overwrite an existing output directory",
+    )
+    args = parser.parse_args()
+
+    converter = TransformersConverter(
+        args.model,
+        copy_files=["tokenizer.json", "preprocessor_config.json"],
+    )
+    output_dir = converter.convert(
+        args.output_dir,
+        quantization=args.quantization,
+        force=args.force,
+    )
+    print(f"Modell gespeichert in {output_dir}")  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()